@@ -1,11 +1,134 @@
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, Request, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response, JSONResponse
-from PIL import Image, ImageEnhance, ImageFilter
-import io
+from fastapi.responses import ORJSONResponse, Response
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+import asyncio
+import cv2
+import hashlib
+import numba
+import numpy as np
+import os
+
+# Images are kept in OpenCV's native layout end to end: 8-bit BGR numpy arrays of shape
+# (height, width, 3), as returned by cv2.imdecode and expected by cv2.imencode.
+# No colorspace conversion pass is needed between decoding and encoding.
+
+# Let OpenCV use its SIMD-optimized code paths
+cv2.setUseOptimized(True)
+
+# Upper bound for the default number of image-processing worker processes
+DEFAULT_MAX_WORKERS = 2
+
+
+def _default_workers() -> int:
+    """
+    Number of pool workers when PROCESS_WORKERS is not set: the CPUs this process may run on,
+    capped because container CPU quotas are usually smaller than the host's core count.
+    """
+    try:
+        available = len(os.sched_getaffinity(0))
+    except AttributeError:
+        available = os.cpu_count() or 1
+    return max(1, min(available, DEFAULT_MAX_WORKERS))
+
+
+# Number of image-processing worker processes (each processes one request at a time)
+PROCESS_WORKERS = int(os.environ.get("PROCESS_WORKERS") or _default_workers())
+
+# Size of each chunk read from an uploaded file
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Largest accepted upload, in bytes
+MAX_UPLOAD_BYTES = 100 << 20
+
+# Largest accepted image, in pixels (width * height)
+MAX_PIXELS = 25_000_000
+
+# Largest width or height the WebP format can encode
+WEBP_MAX_DIMENSION = 16383
+
+# JPEG start-of-frame markers (SOF0-SOF15, excluding DHT, JPG and DAC)
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# Maximum number of encoded results kept for repeated uploads, and their total size in bytes
+RESULT_CACHE_SIZE = 128
+RESULT_CACHE_BYTES = 256 << 20
+
+# LRU cache of encoded results, keyed by (upload SHA-256, phase, media type)
+_result_cache: "OrderedDict[tuple[bytes, str, str], bytes]" = OrderedDict()
+_result_cache_bytes = 0
+
+# Precomputed response headers for each output format
+_IMAGE_HEADERS = {
+    media_type: {"content-type": media_type, "cache-control": "no-store", "vary": "Accept"}
+    for media_type in ("image/webp", "image/png")
+}
+
+# Arterial phase parameters: contrast factor, then an unsharp mask
+# (Gaussian sigma, amount and threshold as in PIL's UnsharpMask(radius=2, percent=120, threshold=3))
+ARTERIAL_CONTRAST = 1.6
+ARTERIAL_SHARPEN_SIGMA = 2.0
+ARTERIAL_SHARPEN_AMOUNT = 1.2
+ARTERIAL_SHARPEN_THRESHOLD = 3
+
+# The arterial kernel works in fixed point with this many fractional bits
+_FIXED_SHIFT = 7
+_FIXED_HALF = 1 << (_FIXED_SHIFT - 1)
+_CONTRAST_FIXED = round(ARTERIAL_CONTRAST * (1 << _FIXED_SHIFT))
+_SHARPEN_AMOUNT_FIXED = round(ARTERIAL_SHARPEN_AMOUNT * (1 << _FIXED_SHIFT))
+_SHARPEN_THRESHOLD_FIXED = ARTERIAL_SHARPEN_THRESHOLD << _FIXED_SHIFT
+
+
+def _init_worker() -> None:
+    """
+    Configure an image-processing worker process.
+    Requests already run in parallel across the pool, so each worker uses a single
+    OpenCV and Numba thread.
+    """
+    cv2.setNumThreads(1)
+    numba.set_num_threads(1)
+    _warmup()
+
+
+def _warmup() -> None:
+    """
+    Run every processing path once on a tiny image, so Numba loads (or compiles and caches)
+    its kernels before the first real request.
+    """
+    dummy = np.zeros((16, 16, 3), np.uint8)
+    for phase in ("arterial", "venous"):
+        process_image(dummy, phase)
+
+
+def _create_pool() -> ProcessPoolExecutor:
+    """
+    Create the process pool that runs CPU-bound image work off the event loop.
+    """
+    return ProcessPoolExecutor(max_workers=PROCESS_WORKERS, initializer=_init_worker)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Manage the image-processing pool for the lifetime of the application.
+    """
+    app.state.pool = _create_pool()
+    # Start a first worker before serving with a no-op task; it warms up in its initializer
+    await asyncio.get_running_loop().run_in_executor(app.state.pool, os.getpid)
+    yield
+    app.state.pool.shutdown()
+
 
 # Initialize FastAPI application
-app = FastAPI(title="MedTech Phase Simulator")
+app = FastAPI(
+    title="MedTech Phase Simulator",
+    lifespan=lifespan,
+    # Serialize JSON with orjson instead of the stdlib json module
+    default_response_class=ORJSONResponse,
+)
 
 # Enable CORS.
 # For simplicity, all origins are allowed.
@@ -19,38 +142,272 @@ app.add_middleware(
 )
 
 
-def process_image(img: Image.Image, phase: str) -> Image.Image:
+# cache=True persists the compiled kernel on disk (in NUMBA_CACHE_DIR when set, otherwise
+# next to this file), so restarted workers load it instead of recompiling
+@numba.njit(parallel=True, fastmath=True, cache=True, boundscheck=False)
+def _arterial_kernel(arr, blurred, mean, out):
+    """
+    Fused contrast enhancement and unsharp mask: each pixel is read and written once.
+    Contrast is linear, so the contrast-enhanced blur is derived from the blur of the input.
+    All arithmetic is integer fixed point, avoiding float conversion.
+    """
+    h, w, channels = arr.shape
+    for y in numba.prange(h):
+        for x in range(w):
+            for c in range(channels):
+                pixel = np.int32(arr[y, x, c])
+                value = (mean << _FIXED_SHIFT) + _CONTRAST_FIXED * (pixel - mean)
+                diff = _CONTRAST_FIXED * (pixel - np.int32(blurred[y, x, c]))
+                if abs(diff) > _SHARPEN_THRESHOLD_FIXED:
+                    value += (_SHARPEN_AMOUNT_FIXED * diff) >> _FIXED_SHIFT
+                out[y, x, c] = min(max((value + _FIXED_HALF) >> _FIXED_SHIFT, 0), 255)
+
+
+def peek_dims(buf: bytes) -> tuple[int, int]:
+    """
+    Read the dimensions of a PNG or JPEG image from its header, without decoding it.
+
+    Parameters:
+        buf (bytes): Image file content.
+
+    Returns:
+        tuple[int, int]: Image width and height.
+    """
+
+    # PNG: the IHDR chunk always comes first, right after the 8-byte signature
+    if buf[:8] == b"\x89PNG\r\n\x1a\n" and buf[12:16] == b"IHDR":
+        return int.from_bytes(buf[16:20], "big"), int.from_bytes(buf[20:24], "big")
+
+    # JPEG: walk the marker segments up to the start-of-frame header
+    if buf[:2] == b"\xff\xd8":
+        offset = 2
+        while offset + 9 <= len(buf):
+            if buf[offset] != 0xFF:
+                break
+            marker = buf[offset + 1]
+            if marker == 0xFF:
+                # Fill byte before a marker
+                offset += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                # Standalone marker without a length field
+                offset += 2
+                continue
+            if marker in _JPEG_SOF_MARKERS:
+                height = int.from_bytes(buf[offset + 5:offset + 7], "big")
+                width = int.from_bytes(buf[offset + 7:offset + 9], "big")
+                return width, height
+            offset += 2 + int.from_bytes(buf[offset + 2:offset + 4], "big")
+
+    raise ValueError("unsupported or malformed image (expected PNG or JPEG)")
+
+
+def decode_image(content: bytes) -> np.ndarray:
+    """
+    Decode an uploaded JPEG/PNG file with OpenCV (libjpeg-turbo for JPEG).
+
+    Parameters:
+        content (bytes): Uploaded image file content.
+
+    Returns:
+        numpy.ndarray: Decoded 8-bit BGR image of shape (height, width, 3).
+    """
+
+    # Wrap the upload without copying; IMREAD_COLOR drops alpha and expands grayscale
+    arr = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR)
+    if arr is None:
+        raise ValueError("cannot decode image")
+    return arr
+
+
+def process_image(arr: np.ndarray, phase: str) -> np.ndarray:
     """
     Apply a simulated medical phase transformation to the input image.
 
     Parameters:
-        img (PIL.Image.Image): Input image.
+        arr (numpy.ndarray): Input 8-bit BGR image.
         phase (str): Selected phase ("arterial" or "venous").
 
     Returns:
-        PIL.Image.Image: Processed image.
+        numpy.ndarray: Processed 8-bit BGR image.
     """
 
-    # Ensure image is in RGB format
-    img = img.convert("RGB")
-
     if phase == "arterial":
-        # Simulate arterial phase by increasing image contrast
-        enhancer = ImageEnhance.Contrast(img)
-        img = enhancer.enhance(1.6)  # Adjustable contrast factor
-
-        # Optional slight sharpening for a more pronounced effect
-        img = img.filter(ImageFilter.UnsharpMask(radius=2, percent=120, threshold=3))
-        return img
+        # Simulate arterial phase by increasing image contrast around the mean gray level,
+        # with a slight sharpening for a more pronounced effect
+        b, g, r, _ = cv2.mean(arr)
+        mean = int(0.299 * r + 0.587 * g + 0.114 * b + 0.5)
+        blurred = cv2.GaussianBlur(
+            arr, (0, 0), sigmaX=ARTERIAL_SHARPEN_SIGMA, borderType=cv2.BORDER_REPLICATE
+        )
+        out = np.empty_like(arr)
+        _arterial_kernel(arr, blurred, mean, out)
+        return out
 
     if phase == "venous":
-        # Simulate venous phase by applying Gaussian smoothing
-        return img.filter(ImageFilter.GaussianBlur(radius=2.0))
+        # Simulate venous phase by applying Gaussian smoothing.
+        # Three successive 5x5 box passes approximate a Gaussian (sigma ~2.4, close to the
+        # former radius=2.0) at a cost independent of the radius.
+        blurred = arr
+        for _ in range(3):
+            blurred = cv2.blur(blurred, (5, 5), borderType=cv2.BORDER_REPLICATE)
+        return blurred
 
     # Defensive programming: raise error if phase is invalid
     raise ValueError("Invalid phase")
 
 
+def accepts_webp(accept: str) -> bool:
+    """
+    Check whether an Accept header explicitly allows WebP.
+
+    Parameters:
+        accept (str): Value of the request's Accept header.
+
+    Returns:
+        bool: True if image/webp is listed with a non-zero quality value.
+    """
+
+    for media_range in accept.split(","):
+        media_type, *params = (part.strip() for part in media_range.split(";"))
+        if media_type.lower() != "image/webp":
+            continue
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def encode_image(arr: np.ndarray, media_type: str) -> bytes:
+    """
+    Encode the processed image in the requested format.
+
+    Parameters:
+        arr (numpy.ndarray): Processed 8-bit BGR image.
+        media_type (str): Output format ("image/webp" or "image/png").
+
+    Returns:
+        bytes: Encoded image.
+    """
+
+    if media_type == "image/webp":
+        # libwebp is SIMD-optimized and produces much smaller files than PNG
+        ok, encoded = cv2.imencode(".webp", arr, [cv2.IMWRITE_WEBP_QUALITY, 85])
+    else:
+        # Fast deflate level: most of the size reduction at a fraction of the default CPU cost
+        ok, encoded = cv2.imencode(".png", arr, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    if not ok:
+        raise ValueError("failed to encode image")
+
+    # Single copy out of OpenCV's buffer, without an intermediate BytesIO
+    return encoded.tobytes()
+
+
+def _process_sync(content: bytes, phase: str, media_type: str) -> bytes:
+    """
+    Decode, process and encode an uploaded image.
+    Runs in a pool worker, so only raw bytes cross the process boundary.
+
+    Parameters:
+        content (bytes): Uploaded image file content.
+        phase (str): Selected phase ("arterial" or "venous").
+        media_type (str): Output format ("image/webp" or "image/png").
+
+    Returns:
+        bytes: Encoded image.
+    """
+
+    # Load image from bytes
+    arr = decode_image(content)
+
+    # Process image according to selected phase
+    processed = process_image(arr, phase)
+
+    return encode_image(processed, media_type)
+
+
+def _cache_result(key: tuple[bytes, str, str], encoded: bytes) -> None:
+    """
+    Store an encoded result, evicting the least recently used ones to stay within
+    RESULT_CACHE_SIZE entries and RESULT_CACHE_BYTES bytes.
+    Results larger than the whole byte budget are not cached.
+    """
+    global _result_cache_bytes
+
+    if len(encoded) > RESULT_CACHE_BYTES:
+        return
+
+    previous = _result_cache.pop(key, None)
+    if previous is not None:
+        _result_cache_bytes -= len(previous)
+
+    _result_cache[key] = encoded
+    _result_cache_bytes += len(encoded)
+    while len(_result_cache) > RESULT_CACHE_SIZE or _result_cache_bytes > RESULT_CACHE_BYTES:
+        _, evicted = _result_cache.popitem(last=False)
+        _result_cache_bytes -= len(evicted)
+
+
+async def run_in_pool(app: FastAPI, fn, *args):
+    """
+    Run a function in the application's process pool.
+    If a worker died (e.g. killed when running out of memory), the broken pool is
+    replaced and the call is retried once.
+
+    Parameters:
+        app (FastAPI): Application owning the pool.
+        fn: Picklable top-level function to run.
+        *args: Arguments passed to fn.
+
+    Returns:
+        The return value of fn.
+    """
+
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = app.state.pool
+        try:
+            return await loop.run_in_executor(pool, fn, *args)
+        except BrokenProcessPool:
+            # Concurrent requests may see the same broken pool; replace it only once
+            if app.state.pool is pool:
+                app.state.pool = _create_pool()
+                pool.shutdown(wait=False)
+            if attempt:
+                raise
+
+
+async def read_upload(file: UploadFile, size_hint: int) -> bytearray:
+    """
+    Read an uploaded file in chunks into a single preallocated buffer.
+
+    Parameters:
+        file (UploadFile): Uploaded file.
+        size_hint (int): Expected file size, as measured by the multipart parser.
+
+    Returns:
+        bytearray: File content, trimmed to the number of bytes read.
+    """
+
+    # Never trust the hint beyond the upload limit: bytearray() zero-fills every page
+    buffer = bytearray(min(size_hint, MAX_UPLOAD_BYTES))
+    offset = 0
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        if offset + len(chunk) > MAX_UPLOAD_BYTES:
+            raise ValueError("upload too large")
+        # Copies in place; grows the buffer only if the size hint was too small
+        buffer[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+
+    del buffer[offset:]
+    return buffer
+
+
 @app.get("/health")
 def health():
     """
@@ -60,47 +417,75 @@ def health():
 
 
 @app.post("/process")
-async def process(file: UploadFile = File(...), phase: str = Form(...)):
+async def process(request: Request, file: UploadFile = File(...), phase: str = Form(...)):
     """
     Receive an uploaded image and a selected phase.
-    Perform image processing on the backend and return the processed image as PNG.
+    Perform image processing on the backend and return the processed image
+    as WebP when the client accepts it, otherwise as PNG.
     """
 
     try:
         # Normalize and validate phase input
         phase = (phase or "").strip().lower()
         if phase not in ("arterial", "venous"):
-            return JSONResponse(
+            return ORJSONResponse(
                 {"success": False, "error": "phase must be arterial or venous"},
                 status_code=400,
             )
 
-        # Read uploaded file content
-        content = await file.read()
+        # Reject oversized uploads before buffering them
+        if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+            return ORJSONResponse(
+                {"success": False, "error": f"file too large (max {MAX_UPLOAD_BYTES} bytes)"},
+                status_code=413,
+            )
+
+        # Read uploaded file content (the multipart parser records its exact size)
+        content = await read_upload(file, file.size or 0)
         if not content:
-            return JSONResponse(
+            return ORJSONResponse(
                 {"success": False, "error": "empty file"},
                 status_code=400,
             )
 
-        # Load image from bytes
-        img = Image.open(io.BytesIO(content))
+        # Reject oversized images from their header, before any decoding
+        width, height = peek_dims(content)
+        if width * height > MAX_PIXELS:
+            return ORJSONResponse(
+                {"success": False, "error": f"image too large (max {MAX_PIXELS} pixels)"},
+                status_code=413,
+            )
+
+        # Prefer WebP when the client accepts it and the image fits within WebP's size limit
+        use_webp = (
+            max(width, height) <= WEBP_MAX_DIMENSION
+            and accepts_webp(request.headers.get("accept", ""))
+        )
+        media_type = "image/webp" if use_webp else "image/png"
 
-        # Process image according to selected phase
-        processed_img = process_image(img, phase)
+        # Repeated uploads are served from the cache without reprocessing
+        key = (hashlib.sha256(content).digest(), phase, media_type)
+        encoded = _result_cache.get(key)
+        if encoded is None:
+            # Decode, process and encode the image in the process pool
+            encoded = await run_in_pool(request.app, _process_sync, content, phase, media_type)
+            _cache_result(key, encoded)
+        else:
+            _result_cache.move_to_end(key)
 
-        # Convert processed image to PNG and return as binary response
-        buffer = io.BytesIO()
-        processed_img.save(buffer, format="PNG")
+        # Return processed image as binary response
+        return Response(content=encoded, headers=_IMAGE_HEADERS[media_type])
 
-        return Response(
-            content=buffer.getvalue(),
-            media_type="image/png"
+    except BrokenProcessPool:
+        # The image could not be processed even by a fresh worker
+        return ORJSONResponse(
+            {"success": False, "error": "image processing unavailable, please retry"},
+            status_code=503,
         )
 
     except Exception as e:
         # Return error details for debugging purposes
-        return JSONResponse(
+        return ORJSONResponse(
             {"success": False, "error": str(e)},
             status_code=400,
         )
\ No newline at end of file